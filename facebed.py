@@ -1,28 +1,100 @@
 import argparse
+import atexit
+import base64
+import concurrent.futures
+import gzip
+import hashlib
+import hmac
+import importlib
+import importlib.util
 import io
+import ipaddress
 import json
 import logging
+import math
 import os
+import queue
+import random
 import re
+import signal
+import socket
 import sys
 import threading
 import time
 import traceback
-from dataclasses import dataclass
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, fields
 from datetime import datetime, timezone, timedelta
-from functools import wraps
+from functools import cache, wraps
+from logging.handlers import QueueHandler, QueueListener
+from socketserver import ThreadingMixIn
 from typing import Self, Callable
 from urllib.parse import quote as _quote_
 from html import escape
 from urllib.parse import urlparse
+from wsgiref.simple_server import WSGIServer
+
+IMPORT_STARTED = time.perf_counter()
 
-import stealth_requests as requests
-import requests as rq
 import yaml
-from bottle import Bottle, request, response, static_file
-from bs4 import BeautifulSoup
-from discord_webhook import DiscordWebhook
-from yattag import indent
+from bottle import Bottle, HTTPResponse, redirect, request, response, static_file
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from compression import zstd  # python 3.14+
+except ImportError:
+    try:
+        import zstandard as zstd
+    except ImportError:
+        zstd = None
+
+startup_timings: list[tuple[str, float]] = []
+
+
+@contextmanager
+def startup_stage(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings.append((name, time.perf_counter() - start))
+
+
+class LazyModule:
+    # imports the module on first attribute access instead of at startup
+    def __init__(self, name: str):
+        self.__dict__['name'] = name
+        self.__dict__['module'] = None
+
+    def load(self):
+        if self.module is None:
+            with startup_stage(f'import {self.name}'):
+                self.__dict__['module'] = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+# these take most of the import time and aren't needed until the first fetch
+requests = LazyModule('stealth_requests')
+rq = LazyModule('requests')
+bs4 = LazyModule('bs4')
+discord_webhook = LazyModule('discord_webhook')
+yattag = LazyModule('yattag')
+LAZY_MODULES = [requests, rq, bs4, discord_webhook, yattag]
 
 CONFIG_STR = '''
 host: "::"
@@ -30,16 +102,54 @@ port: 9812
 timezone: 7
 banned_users: []
 banned_notifier_webhook: ''
+config_watch_interval: 5
+access_log_sample_rate: 1.0
+traceback_interval: 60
+cache_backend: ''
+post_cache_ttl: 300
+share_link_ttl: 86400
+fetch_lease: 30
+api_keys: []
+prefetch_workers: 2
+prefetch_queue_size: 256
+stream_upstream: false
+parse_concurrency: 4
+parse_memory_budget_mb: 512
+parse_queue_timeout: 10.0
+scheduler_slots: 8
+scheduler_queue_timeout: 10.0
+scheduler_weights: {unfurler: 8, api: 2, prefetch: 1}
+rate_limits:
+  unfurler: {rate: 20, burst: 60}
+  api: {rate: 1, burst: 10}
+  prefetch: {rate: 5, burst: 50}
+archive_dir: ''
+archive_max_mb: 512
+collage_dir: ''
+collage_max_images: 16
+collage_max_mb: 256
+collage_workers: 2
+collage_timeout: 20.0
+collage_secret: ''
+public_url: ''
+trusted_proxies: []
+redirect_browsers: true
+unfurler_agents: [Discordbot, TelegramBot, Slackbot, Slack-ImgProxy, Twitterbot, facebookexternalhit, Facebot,
+                  WhatsApp, LinkedInBot, Mastodon, Pleroma, Akkoma, Misskey, Bluesky, Cardyb, SkypeUriPreview,
+                  Iframely, Embedly, redditbot, vkShare, Viber, Zalo, KakaoTalk, Line/, Synapse, Googlebot, bingbot]
 '''.strip()
 
 config: dict = {}
 default_config: dict = yaml.safe_load(io.StringIO(CONFIG_STR))
+config_lock = threading.Lock()
+config_listeners: list[tuple[frozenset[str], Callable[[dict], None]]] = []
 app: Bottle = Bottle()
 
 WWWFB = 'https://www.facebook.com'
 TZ_OFFSET: int = 0
 ALLOW_UPDATE = True
 logging.basicConfig(format='[%(levelname)s] [%(asctime)s] %(msg)s', level=logging.INFO)
+access_logger = logging.getLogger('facebed.access')
 
 
 def quote(s: str) -> str:
@@ -52,8 +162,344 @@ def get_credit() -> str:
     return 'facebed by pi.kt'
 
 
+def on_config_change(*keys: str):
+    # registers a callback that rebuilds whatever it derives from these config keys
+    def decorator(fn: Callable[[dict], None]):
+        config_listeners.append((frozenset(keys), fn))
+        return fn
+
+    return decorator
+
+
+def apply_config(new_config: dict) -> set[str]:
+    global config
+
+    with config_lock:
+        old_config = config
+        changed = {k for k in new_config if k not in config or config[k] != new_config[k]}
+        config = new_config
+        applied = []
+        try:
+            for keys, listener in config_listeners:
+                if keys & changed:
+                    listener(new_config)
+                    applied.append(listener)
+        except Exception as e:
+            # don't leave half of the new config applied, rebuild what already ran from the old one
+            config = old_config
+            if old_config:
+                for listener in applied:
+                    try:
+                        listener(old_config)
+                    except Exception as rollback_error:
+                        logging.error(f'restoring the old config in {listener.__name__} failed: {rollback_error}')
+            raise ConfigError(f'applying the config failed: {type(e).__name__}: {e}')
+    return changed
+
+
+class Trace:
+    traceback_times: dict[tuple, float] = {}
+    traceback_lock = threading.Lock()
+
+    def __init__(self):
+        self.route = '-'
+        self.key = ''
+        self.cache = '-'
+        self.upstream_status: int | None = None
+        self.upstream_bytes: int | None = None
+        self.client = ''
+        self.request_class = 'unfurler'
+        self.ticket: Ticket | None = None
+        self.stages: dict[str, float] = {}
+        self.active: set[str] = set()
+        self.error = ''
+        self.traceback = ''
+
+    @staticmethod
+    def current() -> 'Trace':
+        trace = current_trace.get(None)
+        if trace is None:  # work outside of a request, timings are thrown away
+            trace = Trace()
+            current_trace.set(trace)
+        return trace
+
+    @contextmanager
+    def stage(self, name: str):
+        if name in self.active:  # nested call of the same stage, already being timed
+            yield
+            return
+        self.active.add(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.active.discard(name)
+            self.stages[name] = round(self.stages.get(name, 0) + (time.perf_counter() - start) * 1000, 2)
+
+    def fail(self, e: Exception):
+        self.error = f'{type(e).__name__}: {e}'
+        tb = e.__traceback__
+        while tb and tb.tb_next:
+            tb = tb.tb_next
+        signature = (type(e).__name__, tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb else (type(e).__name__,)
+        now = time.monotonic()
+        with Trace.traceback_lock:
+            if now - Trace.traceback_times.get(signature, -math.inf) < config['traceback_interval']:
+                return
+            Trace.traceback_times[signature] = now
+        self.traceback = ''.join(traceback.format_exception(e))
+
+    def emit(self, status: int, elapsed: float):
+        failed = bool(self.error) or status >= 500
+        if not failed and random.random() >= config['access_log_sample_rate']:
+            return
+        fields = {
+            'remote': client_address(),
+            'method': request.method,
+            'url': request.url,
+            'status': status,
+            'route': self.route,
+            'class': self.request_class,
+            'key': self.key,
+            'cache': self.cache,
+            'upstream_status': self.upstream_status,
+            'upstream_bytes': self.upstream_bytes,
+            'stages': self.stages,
+            'ms': round(elapsed * 1000, 2),
+        }
+        if self.error:
+            fields['error'] = self.error
+        if self.traceback:
+            fields['traceback'] = self.traceback
+        access_logger.log(logging.ERROR if failed else logging.INFO, '', extra={'fields': fields})
+
+
+current_trace: ContextVar[Trace] = ContextVar('current_trace')
+
+
+class LRUCache:
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self.items: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class CacheError(Exception):
+    pass
+
+
+class CacheBackend:
+    def get(self, key: str) -> bytes | None:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: float):
+        raise NotImplementedError
+
+    def acquire(self, key: str, owner: str, lease: float) -> bool:
+        raise NotImplementedError
+
+    def release(self, key: str, owner: str):
+        raise NotImplementedError
+
+    def held(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self, max_items: int = 4096):
+        self.items = LRUCache(max_items)
+        self.leases: dict[str, tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        entry = self.items.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.items.set(key, (time.monotonic() + ttl, value))
+
+    def acquire(self, key: str, owner: str, lease: float) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            holder = self.leases.get(key)
+            if holder and holder[0] != owner and holder[1] > now:
+                return False
+            self.leases[key] = (owner, now + lease)
+            return True
+
+    def release(self, key: str, owner: str):
+        with self.lock:
+            holder = self.leases.get(key)
+            if holder and holder[0] == owner:
+                del self.leases[key]
+
+    def held(self, key: str) -> bool:
+        with self.lock:
+            holder = self.leases.get(key)
+            return bool(holder) and holder[1] > time.monotonic()
+
+
+class RedisBackend(CacheBackend):
+    # speaks RESP directly, anything redis-compatible works (redis, valkey, keydb, dragonfly)
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, url: str, timeout: float = 2.0, max_idle: int = 16):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.username = parsed.username
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.prefix = b'facebed:'
+        self.idle: list[tuple[socket.socket, io.BufferedReader]] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def encode_command(args: tuple) -> bytes:
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    @staticmethod
+    def read_reply(reader: io.BufferedReader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise CacheError('connection closed by cache server')
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise CacheError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            size = int(rest)
+            return None if size < 0 else reader.read(size + 2)[:-2]
+        if kind == b'*':
+            size = int(rest)
+            return None if size < 0 else [RedisBackend.read_reply(reader) for _ in range(size)]
+        raise CacheError(f'unexpected reply from cache server: {line[:32]!r}')
+
+    def connect(self) -> tuple[socket.socket, io.BufferedReader]:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        conn = (sock, sock.makefile('rb'))
+        try:
+            if self.password:
+                self.execute(conn, 'AUTH', *([self.username] if self.username else []), self.password)
+            if self.db:
+                self.execute(conn, 'SELECT', self.db)
+        except Exception:
+            self.discard(conn)
+            raise
+        return conn
+
+    def execute(self, conn: tuple[socket.socket, io.BufferedReader], *args):
+        conn[0].sendall(self.encode_command(args))
+        return self.read_reply(conn[1])
+
+    @staticmethod
+    def discard(conn: tuple[socket.socket, io.BufferedReader]):
+        conn[1].close()
+        conn[0].close()
+
+    def command(self, *args):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        try:
+            conn = conn or self.connect()
+            reply = self.execute(conn, *args)
+        except (OSError, ValueError) as e:
+            if conn:
+                self.discard(conn)
+            raise CacheError(f'cache server {self.host}:{self.port} unavailable: {e}')
+        except CacheError:
+            if conn:
+                self.discard(conn)
+            raise
+
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                conn = None
+        if conn:
+            self.discard(conn)
+        return reply
+
+    def get(self, key: str) -> bytes | None:
+        reply = self.command('GET', self.prefix + key.encode('utf-8'))
+        # some stand-ins answer with a simple string instead of a bulk string
+        return reply.encode('utf-8') if isinstance(reply, str) else reply
+
+    def set(self, key: str, value: bytes, ttl: float):
+        self.command('SET', self.prefix + key.encode('utf-8'), value, 'PX', max(1, int(ttl * 1000)))
+
+    def acquire(self, key: str, owner: str, lease: float) -> bool:
+        reply = self.command('SET', self.prefix + key.encode('utf-8'), owner, 'NX', 'PX', max(1, int(lease * 1000)))
+        return reply == 'OK'
+
+    def release(self, key: str, owner: str):
+        self.command('EVAL', self.RELEASE_SCRIPT, 1, self.prefix + key.encode('utf-8'), owner)
+
+    def held(self, key: str) -> bool:
+        return self.command('EXISTS', self.prefix + key.encode('utf-8')) == 1
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
+
+
+def create_cache_backend(spec: str) -> CacheBackend:
+    if spec in ['', 'memory']:
+        return MemoryBackend()
+    if spec.startswith('redis://'):
+        return RedisBackend(spec)
+    raise ConfigError(f'unknown cache backend {spec}')
+
+
+def timed(stage: str):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Trace.current().stage(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 class Utils:
     @staticmethod
+    @timed('resolve')
     def resolve_share_link(path: str) -> str:
         # cookies not needed to resolve share links
         head_request = rq.head(f'{WWWFB}/{path}', headers=JsonParser.get_headers())
@@ -66,7 +512,7 @@ class Utils:
 
     @staticmethod
     def prettify(txt: str) -> str:
-        return indent(txt, indentation ='    ', newline = '\n', indent_text = True)
+        return yattag.indent(txt, indentation ='    ', newline = '\n', indent_text = True)
 
     @staticmethod
     def warn(msg: str):
@@ -75,7 +521,7 @@ class Utils:
             if not wh or not wh.startswith('https://discord.com/api/webhooks/'):
                 return
             try:
-                webhook = DiscordWebhook(url=config['banned_notifier_webhook'], content=msg)
+                webhook = discord_webhook.DiscordWebhook(url=config['banned_notifier_webhook'], content=msg)
                 webhook.execute()
             except Exception:
                 logging.warning(f'failed to warn about "{msg}"')
@@ -171,29 +617,145 @@ class Jq:
     def last(obj: dict, key: str) -> dict:
         return Jq.iterate(obj, key)[-1]
 
+    @staticmethod
+    def locate(obj: dict, key: str) -> tuple[tuple, object] | None:
+        # same visiting order as enumerate, but stops at the first match and returns the path to it
+        def walk(value, path: tuple):
+            if isinstance(value, dict):
+                if key in value:
+                    return path + (key,), value[key]
+                children = [(k, v) for k, v in value.items() if isinstance(v, list)]
+                children += [(k, v) for k, v in value.items() if isinstance(v, dict)]
+            elif isinstance(value, list):
+                children = [(i, v) for i, v in enumerate(value) if isinstance(v, dict)]
+                children += [(i, v) for i, v in enumerate(value) if isinstance(v, list)]
+            else:
+                return None
+            for step, child in children:
+                found = walk(child, path + (step,))
+                if found:
+                    return found
+            return None
 
-class Cookies:
-    def __init__(self, fn: str):
-        self.cookies: list = []
+        return walk(obj, ())
 
-        if not os.path.isfile(fn):
-            logging.warning('cookies.json not found, non incognito-viewable posts will NOT work')
-            return
 
-        with open(fn) as f:
-            self.cookies = json.load(f)
-            logging.info(f'loaded {len(self.cookies)} cookies from {fn}')
-        self.get_cookies()
+class PathMemo:
+    # a page layout keeps its fields at the same place, so remember where they were found
+    # and only fall back to scanning the whole document when the remembered paths stop working
+    MAX_PATHS = 4
+
+    def __init__(self):
+        self.paths: dict[tuple[str, str], list[tuple[tuple, type]]] = {}
+        self.counts: dict[tuple[str, str], list[int]] = {}
+        self.strategy_scores: dict[str, dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def follow(obj, path: tuple):
+        for step in path:
+            obj = obj[step]
+        return obj
+
+    def count(self, slot: tuple[str, str], hit: bool):
+        with self.lock:
+            counts = self.counts.setdefault(slot, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def first(self, page_type: str, obj: dict, key: str, valid: Callable[[object], bool] = lambda v: True):
+        return self.lookup(page_type, obj, key, valid)[0]
+
+    def lookup(self, page_type: str, obj: dict, key: str, valid: Callable[[object], bool] = lambda v: True,
+               scan: bool = False) -> tuple[object, bool]:
+        # also returns whether a remembered path was used. scan skips them, for when what they found
+        # turned out to be the wrong thing
+        slot = (page_type, key)
+        for i, (path, value_type) in enumerate([] if scan else self.paths.get(slot, [])):
+            try:
+                value = PathMemo.follow(obj, path)
+            except (KeyError, IndexError, TypeError):
+                continue
+            if isinstance(value, value_type) and valid(value):
+                self.count(slot, True)
+                if i > 0:
+                    self.remember(slot, path, value_type)
+                return value, True
+
+        self.count(slot, False)
+        found = Jq.locate(obj, key)
+        if not found:
+            return [], False  # same as Jq.first
+        path, value = found
+        self.remember(slot, path, type(value))
+        return value, False
+
+    def remember(self, slot: tuple[str, str], path: tuple, value_type: type):
+        with self.lock:
+            paths = [(path, value_type)] + [p for p in self.paths.get(slot, []) if p[0] != path]
+            self.paths[slot] = paths[:PathMemo.MAX_PATHS]
+
+    def ordered(self, name: str, strategies: list[Callable]) -> list[Callable]:
+        # sorted is stable, untried strategies keep their written order
+        scores = self.strategy_scores.get(name, {})
+        return sorted(strategies, key=lambda s: scores.get(s.__name__, 0.0), reverse=True)
+
+    def record(self, name: str, strategy: str, ok: bool):
+        with self.lock:
+            scores = self.strategy_scores.setdefault(name, {})
+            scores[strategy] = scores.get(strategy, 0.0) * 0.9 + (0.1 if ok else 0.0)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'fields': {
+                    f'{page_type}:{key}': {
+                        'hits': hits,
+                        'scans': scans,
+                        'hit_rate': round(hits / (hits + scans), 3),
+                        'paths': len(self.paths.get((page_type, key), [])),
+                    }
+                    for (page_type, key), (hits, scans) in self.counts.items()
+                },
+                'strategies': {name: {k: round(v, 3) for k, v in scores.items()}
+                               for name, scores in self.strategy_scores.items()},
+            }
+
+
+extraction_paths = PathMemo()
+
+
+class Cookies:
+    def __init__(self, fn: str):
+        self.fn = fn
+        self.cookies: list | None = None
+        self.lock = threading.Lock()
+
+    def load(self) -> list:
+        # read on first use, not on import
+        with self.lock:
+            if self.cookies is not None:
+                return self.cookies
+            with startup_stage('load cookies'):
+                self.cookies = []
+                if not os.path.isfile(self.fn):
+                    logging.warning('cookies.json not found, non incognito-viewable posts will NOT work')
+                    return self.cookies
+
+                with open(self.fn) as f:
+                    self.cookies = json.load(f)
+                    logging.info(f'loaded {len(self.cookies)} cookies from {self.fn}')
+            return self.cookies
 
     def is_valid_cookie(self, entry: dict) -> bool:
         return int(entry.get('expirationDate', 2**31)) > time.time()
 
     def get_cookies(self) -> dict[str, str]:
-        if any([not self.is_valid_cookie(cookie) for cookie in self.cookies]):
+        cookies = self.load()
+        if any([not self.is_valid_cookie(cookie) for cookie in cookies]):
             Utils.warn('@everyone cookies expired')
             return {}
 
-        return {k['name']: k['value'] for k in self.cookies}
+        return {k['name']: k['value'] for k in cookies}
 
 
 acc = Cookies('cookies.json')
@@ -320,6 +882,32 @@ class ParsedPost:
     shares: str
     video_links: list[str]
     author_picture: str
+    author_id: str = ''
+
+    FORMAT_VERSION = 1
+
+    def dumps(self) -> bytes:
+        return dump_json([ParsedPost.FORMAT_VERSION] + [getattr(self, f.name) for f in fields(self)])
+
+    @staticmethod
+    def loads(data: bytes) -> 'ParsedPost | None':
+        values = orjson.loads(data) if orjson else json.loads(data)
+        if values[0] != ParsedPost.FORMAT_VERSION:
+            return None
+        return ParsedPost(*values[1:])
+
+
+banned_ids: frozenset[str] = frozenset()
+
+
+@on_config_change('banned_users')
+def rebuild_ban_index(new_config: dict):
+    global banned_ids
+    banned_ids = frozenset(str(uid) for uid in new_config['banned_users'])
+
+
+def is_banned(user_id) -> bool:
+    return str(user_id) in banned_ids
 
 
 def banned(url: str) -> ParsedPost:
@@ -333,6 +921,398 @@ class FacebedException(Exception):
     pass
 
 
+class FacebedOverloaded(FacebedException):
+    # says nothing about the post itself, so it's never cached
+    pass
+
+
+class ParseAdmission:
+    # rough peak memory per input byte while parsing
+    HTML_OVERHEAD = 12  # BeautifulSoup tree
+    BLOCK_OVERHEAD = 8  # decoded json
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.waiters: deque[object] = deque()
+        self.active = 0
+        self.in_use = 0
+        self.rejected = 0
+
+    @contextmanager
+    def admit(self, estimate: int):
+        budget = config['parse_memory_budget_mb'] * 1024 * 1024
+        deadline = time.monotonic() + config['parse_queue_timeout']
+        ticket = object()
+        with Trace.current().stage('admission'), self.cond:
+            self.waiters.append(ticket)
+            try:
+                # first come first served, a page larger than the whole budget still gets parsed alone
+                while (self.waiters[0] is not ticket or self.active >= config['parse_concurrency']
+                       or (self.active and self.in_use + estimate > budget)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected += 1
+                        raise FacebedOverloaded('too many pages being parsed, try again later')
+                    self.cond.wait(remaining)
+            finally:
+                self.waiters.remove(ticket)
+                self.cond.notify_all()
+            self.active += 1
+            self.in_use += estimate
+
+        held = [estimate]
+
+        def resize(new_estimate: int):
+            with self.cond:
+                self.in_use += new_estimate - held[0]
+                held[0] = new_estimate
+                self.cond.notify_all()
+
+        try:
+            yield resize
+        finally:
+            with self.cond:
+                self.active -= 1
+                self.in_use -= held[0]
+                self.cond.notify_all()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                'active': self.active,
+                'waiting': len(self.waiters),
+                'in_use_mb': round(self.in_use / 1024 / 1024, 1),
+                'rejected': self.rejected,
+            }
+
+
+parse_admission = ParseAdmission()
+
+
+class FacebedRateLimited(FacebedOverloaded):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, burst: float):
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, rate: float, burst: float) -> bool:
+        now = time.monotonic()
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Ticket:
+    def __init__(self, request_class: str):
+        self.request_class = request_class
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class Scheduler:
+    # weighted fair queuing between request classes in front of the upstream fetch,
+    # with a token bucket per client and class
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues: dict[str, deque[Ticket]] = {}
+        self.finish_tags: dict[str, float] = {}
+        self.clock = 0.0
+        self.running = 0
+        self.buckets: dict[tuple[str, str], TokenBucket] = {}
+        self.metrics: dict[str, dict] = {}
+
+    @staticmethod
+    def weight(request_class: str) -> float:
+        return max(float(config['scheduler_weights'].get(request_class, 1)), 0.001)
+
+    def class_metrics(self, request_class: str) -> dict:
+        return self.metrics.setdefault(request_class, {
+            'served': 0, 'rate_limited': 0, 'rejected': 0, 'wait_ms_avg': 0.0, 'wait_ms_max': 0.0,
+        })
+
+    def allow(self, client: str, request_class: str) -> bool:
+        limit = config['rate_limits'].get(request_class)
+        if not limit or not limit.get('rate'):
+            return True
+        rate, burst = float(limit['rate']), float(limit.get('burst', limit['rate']))
+        bucket = self.buckets.get((request_class, client))
+        if bucket is None:
+            if len(self.buckets) >= Scheduler.MAX_BUCKETS:
+                # buckets idle long enough to be full again carry no state
+                idle = time.monotonic() - max(burst / rate, 1)
+                self.buckets = {k: b for k, b in self.buckets.items() if b.updated > idle}
+            bucket = self.buckets[(request_class, client)] = TokenBucket(burst)
+        return bucket.take(rate, burst)
+
+    def dispatch(self):
+        # caller holds the lock
+        while self.running < config['scheduler_slots']:
+            best = None
+            for request_class, waiting in self.queues.items():
+                if not waiting:
+                    continue
+                finish = max(self.finish_tags.get(request_class, 0.0), self.clock) + 1 / self.weight(request_class)
+                if best is None or finish < best[0]:
+                    best = (finish, request_class)
+            if best is None:
+                return
+            finish, request_class = best
+            self.clock = finish - 1 / self.weight(request_class)
+            self.finish_tags[request_class] = finish
+            ticket = self.queues[request_class].popleft()
+            ticket.granted = True
+            self.running += 1
+
+            metrics = self.class_metrics(request_class)
+            waited = (time.monotonic() - ticket.enqueued) * 1000
+            metrics['served'] += 1
+            metrics['wait_ms_avg'] = round(metrics['wait_ms_avg'] * 0.9 + waited * 0.1, 2)
+            metrics['wait_ms_max'] = round(max(metrics['wait_ms_max'] * 0.99, waited), 2)
+            self.cond.notify_all()
+
+    def run(self, trace: Trace, fn: Callable[[], ParsedPost]) -> ParsedPost:
+        with self.cond:
+            if not self.allow(trace.client, trace.request_class):
+                self.class_metrics(trace.request_class)['rate_limited'] += 1
+                raise FacebedRateLimited('rate limited, try again later')
+            ticket = Ticket(trace.request_class)
+            self.queues.setdefault(ticket.request_class, deque()).append(ticket)
+            trace.ticket = ticket
+            deadline = time.monotonic() + config['scheduler_queue_timeout']
+            with trace.stage('queue'):
+                self.dispatch()
+                while not ticket.granted:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.queues[ticket.request_class].remove(ticket)
+                        self.class_metrics(ticket.request_class)['rejected'] += 1
+                        trace.ticket = None
+                        raise FacebedOverloaded('upstream queue is full, try again later')
+                    self.cond.wait(remaining)
+            trace.ticket = None
+
+        try:
+            return fn()
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.dispatch()
+
+    def boost(self, leader: Trace, request_class: str):
+        # someone in a more urgent class is waiting on this fetch, queue it there instead
+        with self.cond:
+            ticket = leader.ticket
+            if not ticket or ticket.granted or self.weight(request_class) <= self.weight(ticket.request_class):
+                return
+            self.queues[ticket.request_class].remove(ticket)
+            ticket.request_class = request_class
+            self.queues.setdefault(request_class, deque()).append(ticket)
+            self.dispatch()
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                'running': self.running,
+                'slots': config['scheduler_slots'],
+                'classes': {
+                    request_class: {'depth': len(self.queues.get(request_class, ())), **metrics}
+                    for request_class, metrics in self.metrics.items()
+                },
+            }
+
+
+scheduler = Scheduler()
+
+
+class PageBlocks:
+    # the data-sjs json script blocks of a page, which is all the parsers read
+    def __init__(self, blocks: list[tuple[int, str]]):
+        self.blocks = blocks
+
+    @staticmethod
+    @timed('parse')
+    def from_html(html: str) -> 'PageBlocks':
+        html_parser = bs4.BeautifulSoup(html, 'html.parser')
+        script_elements = html_parser.find_all('script', attrs={'type': 'application/json', 'data-content-len': True, 'data-sjs': True})
+        page = PageBlocks([(int(e.attrs['data-content-len']), e.text) for e in script_elements])
+        # the tree is full of parent/child cycles, break them instead of waiting for the gc
+        html_parser.decompose()
+        return page
+
+    def size(self) -> int:
+        return sum([len(text) for _, text in self.blocks])
+
+
+class ScriptBlockScanner:
+    OPEN_TAG = re.compile(rb'<script\b([^>]*)>')
+    CONTENT_LEN = re.compile(rb'data-content-len="(\d+)"')
+    CLOSE_TAG = b'</script>'
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.attrs: bytes | None = None  # attributes of the script tag whose body is being read
+        self.close_from = 0
+        self.blocks: list[tuple[int, str]] = []
+
+    def feed(self, chunk: bytes) -> list[tuple[int, str]]:
+        # returns the json blocks completed by this chunk, only the unfinished tail is kept in memory
+        self.buffer += chunk
+        found = []
+        while True:
+            if self.attrs is None:
+                match = self.OPEN_TAG.search(self.buffer)
+                if not match:
+                    tail = self.buffer.rfind(b'<')
+                    del self.buffer[:tail if tail >= 0 else len(self.buffer)]
+                    break
+                self.attrs = match.group(1)
+                self.close_from = 0
+                del self.buffer[:match.end()]
+
+            end = self.buffer.find(self.CLOSE_TAG, self.close_from)
+            if end < 0:
+                self.close_from = max(0, len(self.buffer) - len(self.CLOSE_TAG))
+                break
+
+            content_len = self.CONTENT_LEN.search(self.attrs)
+            if b'type="application/json"' in self.attrs and b'data-sjs' in self.attrs and content_len:
+                found.append((int(content_len.group(1)), self.buffer[:end].decode('utf-8', 'replace')))
+            del self.buffer[:end + len(self.CLOSE_TAG)]
+            self.attrs = None
+
+        self.blocks.extend(found)
+        return found
+
+
+def prune_oldest(filenames: list[str], max_bytes: float) -> int:
+    # deletes the least recently written files until the rest fit, returns the size left
+    entries = []
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, filename))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, filename in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(filename)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return total
+
+
+class PageArchive:
+    # raw page blocks on disk, so parser fixes can be checked without fetching from facebook again
+    QUEUE_SIZE = 64
+    PRUNE_TO = 0.9
+
+    def __init__(self):
+        self.queue: queue.Queue[tuple[str, PageBlocks, bool, float]] = queue.Queue(maxsize=PageArchive.QUEUE_SIZE)
+        self.writer: threading.Thread | None = None
+        self.total: int | None = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def extension() -> str:
+        return '.json.zst' if zstd else '.json.gz'
+
+    @staticmethod
+    def file_for(directory: str, key: str) -> str:
+        return os.path.join(directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + PageArchive.extension())
+
+    @staticmethod
+    def files(directory: str) -> list[str]:
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in os.listdir(directory)
+                if name.endswith('.json.zst') or name.endswith('.json.gz')]
+
+    @staticmethod
+    def load(filename: str) -> dict:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if filename.endswith('.zst'):
+            if not zstd:
+                raise ValueError('zstd support is not installed')
+            data = zstd.decompress(data)
+        else:
+            data = gzip.decompress(data)
+        return json.loads(data)
+
+    def save(self, key: str, page: PageBlocks, streamed: bool):
+        if not config['archive_dir']:
+            return
+        with self.lock:
+            if not self.writer or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+        try:
+            self.queue.put_nowait((key, page, streamed, time.time()))
+        except queue.Full:
+            logging.debug(f'archive queue full, not archiving {key}')
+
+    def write_loop(self):
+        while True:
+            key, page, streamed, fetched = self.queue.get()
+            try:
+                self.write(key, page, streamed, fetched)
+            except OSError as e:
+                logging.warning(f'archiving {key} failed: {e}')
+
+    def write(self, key: str, page: PageBlocks, streamed: bool, fetched: float):
+        directory = config['archive_dir']
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        kind, _, path = key.partition(':')
+        record = dump_json({'key': key, 'kind': kind, 'path': path, 'fetched': fetched, 'streamed': streamed,
+                            'blocks': page.blocks})
+        data = zstd.compress(record, level=9) if zstd else gzip.compress(record)
+
+        filename = PageArchive.file_for(directory, key)
+        old_size = os.path.getsize(filename) if os.path.exists(filename) else 0
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(filename + '.tmp', filename)
+
+        with self.lock:
+            if self.total is None:
+                self.total = sum(os.path.getsize(f) for f in PageArchive.files(directory))
+            else:
+                self.total += len(data) - old_size
+            if self.total > config['archive_max_mb'] * 1024 * 1024:
+                self.prune(directory)
+
+    def prune(self, directory: str):
+        # down a bit below the cap so this doesn't run on every write
+        self.total = prune_oldest(PageArchive.files(directory), config['archive_max_mb'] * 1024 * 1024 * PageArchive.PRUNE_TO)
+
+    def reset(self):
+        with self.lock:
+            self.total = None
+
+
+page_archive = PageArchive()
+
+
+@on_config_change('archive_dir', 'archive_max_mb')
+def reset_page_archive(new_config: dict):
+    page_archive.reset()
+
+
 class JsonParser:
     @staticmethod
     def get_headers() -> dict:
@@ -360,15 +1340,15 @@ class JsonParser:
 
 
     @staticmethod
-    def get_json_blocks(html_parser: BeautifulSoup, sort=True) -> list[str]:
-        script_elements = html_parser.find_all('script', attrs={'type': 'application/json', 'data-content-len': True, 'data-sjs': True})
+    def get_json_blocks(page: PageBlocks, sort=True) -> list[str]:
+        blocks = page.blocks
         if sort:
-            script_elements.sort(key=lambda e: int(e.attrs['data-content-len']), reverse=True)
-        return [e.text for e in script_elements]
+            blocks = sorted(blocks, key=lambda b: b[0], reverse=True)
+        return [text for _, text in blocks]
 
     @staticmethod
-    def get_post_json(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_post_json(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'i18n_reaction_count' in json_block:  # TODO: add more robust detection
                 bloc = json.loads(json_block)
                 assert bloc
@@ -376,8 +1356,8 @@ class JsonParser:
         raise FacebedException('cannot find post json')
 
     @staticmethod
-    def get_group_name(html_parser: BeautifulSoup) -> str:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_group_name(page: PageBlocks) -> str:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'group_member_profiles' in json_block and 'formatted_count_text' in json_block:
                 group_json = json.loads(json_block)
                 for group_object in Jq.all(group_json, 'group'):
@@ -386,9 +1366,10 @@ class JsonParser:
         return ''
 
     @staticmethod
-    def get_interaction_counts(post_json: dict) -> tuple[str, str, str]:
+    def get_interaction_counts(post_json: dict, page_type: str = 'post') -> tuple[str, str, str]:
         assert post_json
-        post_feedback = Jq.first(post_json, 'comet_ufi_summary_and_actions_renderer')
+        post_feedback = extraction_paths.first(page_type, post_json, 'comet_ufi_summary_and_actions_renderer',
+                                               lambda v: 'feedback' in v)
         assert post_feedback
         reactions = post_feedback['feedback']['i18n_reaction_count']
         shares = post_feedback['feedback']['i18n_share_count']
@@ -396,121 +1377,225 @@ class JsonParser:
         return str(reactions), str(comments), str(shares)
 
     @staticmethod
-    def get_root_node(post_json: dict) -> dict:
+    def get_root_node(post_json: dict, scan: bool = False) -> dict:
+        memo_used = False
+        # the strategies share lookups, a second one would hit the path the first just remembered
+        found: dict[tuple[str, str, int], object] = {}
+
+        def first(page_type: str, obj: dict, key: str, valid: Callable[[object], bool] = lambda v: True):
+            nonlocal memo_used
+            if (page_type, key, id(obj)) not in found:
+                value, hit = extraction_paths.lookup(page_type, obj, key, valid, scan)
+                memo_used = memo_used or hit
+                found[(page_type, key, id(obj))] = value
+            return found[(page_type, key, id(obj))]
+
+        def is_root_data(v) -> bool:
+            return 'node' in v or 'node_v2' in v or 'comet_ufi_summary_and_actions_renderer' in v
+
         def work_normal_post() -> dict:
-            data_blob = Jq.first(post_json, 'data')
+            data_blob = first('post', post_json, 'data', is_root_data)
             if 'comet_ufi_summary_and_actions_renderer' in data_blob:   # single photo
                 return data_blob
             else:
                 return data_blob['node']['comet_sections']
 
         def work_group_post() -> dict:
-            hoisted_feed = Jq.first(post_json, 'group_hoisted_feed')
-            comet_section = Jq.first(hoisted_feed, 'comet_sections')
+            hoisted_feed = first('post', post_json, 'group_hoisted_feed')
+            comet_section = first('group_feed', hoisted_feed, 'comet_sections', lambda v: 'content' in v)
             return comet_section
 
         def work_group_post_v2() -> dict:
-            data_blob = Jq.first(post_json, 'data')
+            data_blob = first('post', post_json, 'data', is_root_data)
             if 'node_v2' in data_blob and 'comet_sections' in data_blob['node_v2']:
                 return data_blob['node_v2']['comet_sections']
             return None
 
         methods: list[Callable[[], dict]] = [work_normal_post, work_group_post, work_group_post_v2]
 
-        for method in methods:
+        for method in extraction_paths.ordered('root_node', methods):
             try:
                 ret = method()
-                if ret:
-                    return ret
-                else:
-                    continue
             except (StopIteration, KeyError):
-                continue
-
-
+                ret = None
+            if not scan:
+                extraction_paths.record('root_node', method.__name__, bool(ret))
+            if ret:
+                return ret
+
+        if memo_used and not scan:
+            # a remembered path can land on a lookalike when the layout changes, scan once before giving up
+            return JsonParser.get_root_node(post_json, scan=True)
         raise FacebedException('Cannot process post')
 
     @staticmethod
     def ensure_full_url(u: str) -> str:
-        if u.startswith(WWWFB):
-            return u
-        else:
-            return f'{WWWFB}/{u.removeprefix("/")}'
+        url = u if u.startswith(WWWFB) else f'{WWWFB}/{u.removeprefix("/")}'
+        # the cookies go wherever this points, https://www.facebook.com@example.com included
+        parsed = urlparse(url)
+        if parsed.scheme != 'https' or parsed.netloc != 'www.facebook.com':
+            raise FacebedException(f'refusing to fetch {url}')
+        return url
+
+    @staticmethod
+    @timed('fetch')
+    def fetch_page(post_path: str, with_cookies: bool = True) -> str:
+        http_response = requests.get(JsonParser.ensure_full_url(post_path), headers=JsonParser.get_headers(),
+                                     cookies=acc.get_cookies() if with_cookies else None)
+        trace = Trace.current()
+        trace.upstream_status = http_response.status_code
+        trace.upstream_bytes = len(http_response.content)
+        return http_response.text
+
+    @staticmethod
+    @timed('fetch')
+    def still_missing(missing: list[tuple[str, ...]], text: str) -> list[tuple[str, ...]]:
+        return [markers for markers in missing if not all([m in text for m in markers])]
+
+    @staticmethod
+    def stream_prefix(blocks: list[tuple[int, str]], required: list[tuple[str, ...]]) -> list[tuple[int, str]]:
+        # the blocks stream_page would have stopped after, for comparing against a full page
+        missing = list(required)
+        for i, (_, text) in enumerate(blocks):
+            missing = JsonParser.still_missing(missing, text)
+            if not missing:
+                return blocks[:i + 1]
+        return blocks
+
+    @staticmethod
+    def stream_page(post_path: str, required: list[tuple[str, ...]], with_cookies: bool = True) -> PageBlocks:
+        # stops reading as soon as every required block has been seen. the parsers pick the largest
+        # matching block of the whole page, so a page with several matching blocks can parse differently,
+        # --check-stream compares both modes over the page archive
+        scanner = ScriptBlockScanner()
+        missing = list(required)
+        trace = Trace.current()
+        trace.upstream_bytes = 0
+        with requests.StealthSession() as session:
+            http_response = session.get(JsonParser.ensure_full_url(post_path), headers=JsonParser.get_headers(),
+                                        cookies=acc.get_cookies() if with_cookies else None, stream=True)
+            trace.upstream_status = http_response.status_code
+            try:
+                for chunk in http_response.iter_content():
+                    trace.upstream_bytes += len(chunk)
+                    for _, text in scanner.feed(chunk):
+                        missing = JsonParser.still_missing(missing, text)
+                    if not missing:
+                        break
+            finally:
+                http_response.close()
+        return PageBlocks(scanner.blocks)
+
+    @staticmethod
+    def fetch_and_parse(kind: str, post_path: str, required: list[tuple[str, ...]],
+                        parse: Callable[[PageBlocks, str], ParsedPost], with_cookies: bool = True) -> ParsedPost:
+        if config['stream_upstream']:
+            page = JsonParser.stream_page(post_path, required, with_cookies)
+            page_archive.save(f'{kind}:{post_path}', page, streamed=True)
+            with parse_admission.admit(page.size() * ParseAdmission.BLOCK_OVERHEAD):
+                return parse(page, post_path)
+
+        html = JsonParser.fetch_page(post_path, with_cookies)
+        with parse_admission.admit(len(html) * ParseAdmission.HTML_OVERHEAD) as resize:
+            page = PageBlocks.from_html(html)
+            # only the blocks are needed from here on
+            del html
+            resize(page.size() * ParseAdmission.BLOCK_OVERHEAD)
+            page_archive.save(f'{kind}:{post_path}', page, streamed=False)
+            return parse(page, post_path)
+
+    @staticmethod
+    def required_blocks(post_path: str) -> list[tuple[str, ...]]:
+        required = [('i18n_reaction_count',)]
+        # permalink.php and story.php can be group posts too, only <user>/posts/ never is
+        if not re.match('^/?[^/]+/posts/', post_path):
+            required.append(('group_member_profiles', 'formatted_count_text'))
+        return required
 
     @staticmethod
     def process_post(post_path: str) -> ParsedPost:
-        http_response = requests.get(JsonParser.ensure_full_url(post_path),
-                                     headers=JsonParser.get_headers(), cookies=acc.get_cookies())
-        html_parser = BeautifulSoup(http_response.text, 'html.parser')
+        return JsonParser.fetch_and_parse('post', post_path, JsonParser.required_blocks(post_path), JsonParser.parse_page)
 
-        post_json = JsonParser.get_root_node(JsonParser.get_post_json(html_parser))
+    @staticmethod
+    @timed('parse')
+    def parse_page(page: PageBlocks, post_path: str) -> ParsedPost:
+        post_json = JsonParser.get_root_node(JsonParser.get_post_json(page))
         likes, cmts, shares = JsonParser.get_interaction_counts(post_json)
         # noinspection PyTypeChecker
-        post_date = int(Jq.first(post_json['context_layout']['story']['comet_sections']['metadata'], 'creation_time'))
+        post_date = int(extraction_paths.first('post', post_json['context_layout']['story']['comet_sections']['metadata'],
+                                               'creation_time'))
         post_json = post_json['content']['story']
 
         story = Story(post_json)
         post_url = story.url
         post_content = story.get_text()
-        post_group_name = JsonParser.get_group_name(html_parser)
+        post_group_name = JsonParser.get_group_name(page)
         post_author_name = story.author_name
         link_header = f'{post_author_name}' + (f' • {post_group_name}' if post_group_name else '')
 
-        if story.author_id in config['banned_users']:
-            return banned(post_url)
-
         # TODO: support normal /watch here
         return ParsedPost(link_header, post_content.strip(), story.image_links, post_url, post_date,
-                          likes, cmts, shares, story.video_links, story.author_picture)
+                          likes, cmts, shares, story.video_links, story.author_picture, str(story.author_id))
 
 
 
 class SinglePhotoParser:
     @staticmethod
-    def get_content_node(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_content_node(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'message_preferred_body' in json_block and 'container_story' in json_block:
                 return Jq.first(json.loads(json_block), 'data')
         raise FacebedException('Cannot process post (cn)')
 
     @staticmethod
-    def get_interactions_node(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_interactions_node(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'comet_ufi_summary_and_actions_renderer' in json_block:
                 return json.loads(json_block)
         raise FacebedException('Cannot process post (in)')
 
     @staticmethod
-    def get_single_image(html_parser: BeautifulSoup) -> str:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_single_image(page: PageBlocks) -> str:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'prefetch_uris_v2' in json_block:
                 return str(Jq.first(json.loads(json_block), 'prefetch_uris_v2')[0]['uri'])
         raise FacebedException('cannot find single image')
 
+    REQUIRED_BLOCKS = [('message_preferred_body', 'container_story'), ('comet_ufi_summary_and_actions_renderer',),
+                       ('prefetch_uris_v2',)]
+
+    @staticmethod
+    def required_blocks(post_path: str) -> list[tuple[str, ...]]:
+        return SinglePhotoParser.REQUIRED_BLOCKS
+
+    @staticmethod
+    def process_post(post_path: str) -> ParsedPost:
+        return JsonParser.fetch_and_parse('photo', post_path, SinglePhotoParser.required_blocks(post_path),
+                                          SinglePhotoParser.parse_page)
+
     @staticmethod
-    def process_post(post_path: str):
-        http_response = requests.get(JsonParser.ensure_full_url(post_path),
-                                     headers=JsonParser.get_headers(), cookies=acc.get_cookies())
-        html_parser = BeautifulSoup(http_response.text, 'html.parser')
-        content_node = SinglePhotoParser.get_content_node(html_parser)
-        interaction_node = SinglePhotoParser.get_interactions_node(html_parser)
+    @timed('parse')
+    def parse_page(page: PageBlocks, post_path: str) -> ParsedPost:
+        content_node = SinglePhotoParser.get_content_node(page)
+        interaction_node = SinglePhotoParser.get_interactions_node(page)
 
         post_text = content_node['message']['text'] if content_node['message'] and 'text' in content_node['message'] else ''
         post_author = content_node['owner']['name']
         post_date = content_node['created_time']
         author_picture = Story.get_profile_picture(content_node['owner'])
-        likes, cmts, shares = JsonParser.get_interaction_counts(interaction_node)
-        image_url = SinglePhotoParser.get_single_image(html_parser)
+        likes, cmts, shares = JsonParser.get_interaction_counts(interaction_node, 'photo')
+        image_url = SinglePhotoParser.get_single_image(page)
 
         return ParsedPost(post_author, post_text.strip(), [image_url], JsonParser.ensure_full_url(post_path),
-                          post_date, likes, cmts, shares, [], author_picture)
+                          post_date, likes, cmts, shares, [], author_picture, str(content_node['owner'].get('id', '')))
 
 
 class ReelsParser:
     @staticmethod
-    def get_video_link(html_parser: BeautifulSoup|None, user_node: dict = None) -> str:
+    def get_video_link(page: PageBlocks | None, user_node: dict = None) -> str:
         def work_node(node: dict) -> str:
-            video_node = Jq.first(node, 'videoDeliveryLegacyFields')
+            video_node = extraction_paths.first('attachment' if user_node else 'reel', node, 'videoDeliveryLegacyFields',
+                                                lambda v: 'browser_native_hd_url' in v or 'browser_native_sd_url' in v)
             for key in ['browser_native_hd_url', 'browser_native_sd_url']:
                 try:
                     video_link = Jq.first(video_node, key)
@@ -525,7 +1610,7 @@ class ReelsParser:
             return work_node(user_node)
 
         # randomly breaks if sorted
-        for json_block in JsonParser.get_json_blocks(html_parser, sort=False):
+        for json_block in JsonParser.get_json_blocks(page, sort=False):
             if 'browser_native_hd_url' in json_block or 'browser_native_sd_url' in json_block:
                 return work_node(json.loads(json_block))
 
@@ -533,16 +1618,16 @@ class ReelsParser:
 
 
     @staticmethod
-    def get_content_node(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_content_node(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'browser_native_' in json_block and 'creation_story' in json_block:
-                return Jq.first(json.loads(json_block), 'creation_story')
+                return extraction_paths.first('reel', json.loads(json_block), 'creation_story', lambda v: 'id' in v)
         raise FacebedException('Invalid reels link (cn)')
 
     @staticmethod
-    def get_reaction_counts(html_parser: BeautifulSoup, is_ig: bool, video_id: str) -> tuple[str, str, str]:
+    def get_reaction_counts(page: PageBlocks, is_ig: bool, video_id: str) -> tuple[str, str, str]:
         blocks: list[dict] = []
-        for json_block in JsonParser.get_json_blocks(html_parser, sort=False):
+        for json_block in JsonParser.get_json_blocks(page, sort=False):
             if 'unified_reactors' in json_block:
                 block = json.loads(json_block)
                 if any([vid == video_id for vid in Jq.all(block, 'id')]):
@@ -567,14 +1652,27 @@ class ReelsParser:
         return Utils.human_format(likes), Utils.human_format(cmts), Utils.human_format(shares)
 
 
+    REQUIRED_BLOCKS = [('browser_native_', 'creation_story'), ('unified_reactors',)]
+
+    @staticmethod
+    def required_blocks(post_path: str) -> list[tuple[str, ...]]:
+        # get_reaction_counts wants the unified_reactors block of this video, not just any
+        video_id = re.match('^/?reel/([0-9]+)', post_path)
+        if not video_id:
+            return ReelsParser.REQUIRED_BLOCKS
+        return [ReelsParser.REQUIRED_BLOCKS[0], ('unified_reactors', f'"{video_id.group(1)}"')]
+
     @staticmethod
     def process_post(post_path: str) -> ParsedPost:
-        http_response = requests.get(JsonParser.ensure_full_url(post_path),
-                                     headers=JsonParser.get_headers())
-        html_parser = BeautifulSoup(http_response.text, 'html.parser')
-        content_node = ReelsParser.get_content_node(html_parser)
+        return JsonParser.fetch_and_parse('reel', post_path, ReelsParser.required_blocks(post_path), ReelsParser.parse_page,
+                                          with_cookies=False)
+
+    @staticmethod
+    @timed('parse')
+    def parse_page(page: PageBlocks, post_path: str) -> ParsedPost:
+        content_node = ReelsParser.get_content_node(page)
 
-        video_link = ReelsParser.get_video_link(html_parser)
+        video_link = ReelsParser.get_video_link(page)
         video_id = content_node['id']
         owner_info = content_node['short_form_video_context']['video_owner']
         is_ig = owner_info['__typename'].startswith('InstagramUser')
@@ -584,64 +1682,73 @@ class ReelsParser:
         post_text = content_node['message']['text']
         author_picture = Story.get_profile_picture(owner_info)
 
-        likes, cmts, shares = ReelsParser.get_reaction_counts(html_parser, is_ig, video_id)
+        likes, cmts, shares = ReelsParser.get_reaction_counts(page, is_ig, video_id)
 
-        if owner_info['id'] in config['banned_users']:
-            return banned(post_url)
-
-        return ParsedPost(op_name, post_text, [], post_url, post_date, likes, cmts, shares, [video_link], author_picture)
+        return ParsedPost(op_name, post_text, [], post_url, post_date, likes, cmts, shares, [video_link], author_picture,
+                          str(owner_info['id']))
 
 
 class VideoWatchParser:
     # excluding group post video since they are handled by jsonparser
     @staticmethod
-    def get_owner_info(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser, sort=False):
+    def get_owner_info(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page, sort=False):
             if 'is_additional_profile_plus' in json_block:
                 bloc = json.loads(json_block)
                 return Jq.first(bloc, 'owner')
         raise FacebedException('Invalid watch link (opn)')
 
     @staticmethod
-    def get_op_name(html_parser: BeautifulSoup) -> str:
-        return VideoWatchParser.get_owner_info(html_parser)['name']
+    def get_op_name(page: PageBlocks) -> str:
+        return VideoWatchParser.get_owner_info(page)['name']
 
 
     @staticmethod
-    def get_content_node(html_parser: BeautifulSoup) -> dict:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_content_node(page: PageBlocks) -> dict:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'comment_rendering_instance' in json_block and 'video_view_count_renderer' in json_block:
                 return Jq.first(json.loads(json_block), 'result')['data']
         raise FacebedException('Invalid watch link (cn)')
 
     @staticmethod
-    def get_date(html_parser: BeautifulSoup) -> int:
-        for json_block in JsonParser.get_json_blocks(html_parser):
+    def get_date(page: PageBlocks) -> int:
+        for json_block in JsonParser.get_json_blocks(page):
             if 'creation_time' in json_block:
                 #   noinspection PyTypeChecker
-                return int(Jq.first(json.loads(json_block), 'creation_time'))
+                return int(extraction_paths.first('watch', json.loads(json_block), 'creation_time'))
         raise FacebedException('cannot find date')
 
+    REQUIRED_BLOCKS = [('is_additional_profile_plus',), ('comment_rendering_instance', 'video_view_count_renderer'),
+                       ('browser_native_',), ('creation_time',)]
+
+    @staticmethod
+    def required_blocks(post_path: str) -> list[tuple[str, ...]]:
+        return VideoWatchParser.REQUIRED_BLOCKS
+
     @staticmethod
     def process_post(post_path: str) -> ParsedPost:
-        http_response = requests.get(JsonParser.ensure_full_url(post_path),
-                                     headers=JsonParser.get_headers(), cookies=acc.get_cookies())
-        html_parser = BeautifulSoup(http_response.text, 'html.parser')
-        content_node = VideoWatchParser.get_content_node(html_parser)
+        return JsonParser.fetch_and_parse('watch', post_path, VideoWatchParser.required_blocks(post_path),
+                                          VideoWatchParser.parse_page)
+
+    @staticmethod
+    @timed('parse')
+    def parse_page(page: PageBlocks, post_path: str) -> ParsedPost:
+        content_node = VideoWatchParser.get_content_node(page)
 
-        video_link = ReelsParser.get_video_link(html_parser)
+        video_link = ReelsParser.get_video_link(page)
 
         post_url = JsonParser.ensure_full_url(post_path)
-        owner_info = VideoWatchParser.get_owner_info(html_parser)
+        owner_info = VideoWatchParser.get_owner_info(page)
         op_name = owner_info['name']
         author_picture = Story.get_profile_picture(owner_info)
         post_text = content_node['title']['text'] if content_node['title'] else ''
         likes = Utils.human_format(content_node['feedback']['reaction_count']['count'])
         shares = None
         cmts = Utils.human_format(content_node['feedback']['total_comment_count'])
-        post_date = VideoWatchParser.get_date(html_parser)
+        post_date = VideoWatchParser.get_date(page)
 
-        return ParsedPost(op_name, post_text, [], post_url, post_date, likes, cmts, shares, [video_link], author_picture)
+        return ParsedPost(op_name, post_text, [], post_url, post_date, likes, cmts, shares, [video_link], author_picture,
+                          str(owner_info.get('id', '')))
 
 
 def format_parsed_post_json(post: ParsedPost) -> dict:
@@ -664,6 +1771,71 @@ def format_parsed_post_json(post: ParsedPost) -> dict:
     }
 
 
+class Encoding:
+    MIN_SIZE = 512
+    PREFERENCE = ['zstd', 'br', 'gzip']
+    ENCODERS: dict[str, Callable[[bytes], bytes]] = {
+        'gzip': lambda body: gzip.compress(body, compresslevel=6),
+    }
+    if brotli:
+        ENCODERS['br'] = lambda body: brotli.compress(body, quality=5)
+    if zstd:
+        ENCODERS['zstd'] = lambda body: zstd.compress(body, level=3)
+
+    # keyed by body digest, so identical results are only compressed once
+    cache = LRUCache(1024)
+
+    @staticmethod
+    def negotiate(accept_encoding: str) -> str | None:
+        weights: dict[str, float] = {}
+        for part in accept_encoding.lower().split(','):
+            name, _, params = part.partition(';')
+            params = params.strip()
+            try:
+                weights[name.strip()] = float(params[2:]) if params.startswith('q=') else 1.0
+            except ValueError:
+                weights[name.strip()] = 0.0
+
+        def weight(enc: str) -> float:
+            return weights.get(enc, weights.get('*', 0.0))
+
+        candidates = [enc for enc in Encoding.PREFERENCE if enc in Encoding.ENCODERS and weight(enc) > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=weight)
+
+    @staticmethod
+    def encode(body: bytes, encoding: str) -> bytes:
+        key = (hashlib.sha1(body).digest(), encoding)
+        encoded = Encoding.cache.get(key)
+        if encoded is None:
+            encoded = Encoding.ENCODERS[encoding](body)
+            Encoding.cache.set(key, encoded)
+        return encoded
+
+
+def dump_json(obj, pretty: bool = False) -> bytes:
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def api_response(payload: dict) -> bytes:
+    body = dump_json(payload, pretty=request.query.get('pretty') in ['1', 'true'])
+    response.set_header('Vary', 'Accept-Encoding')
+    if len(body) < Encoding.MIN_SIZE:
+        return body
+
+    encoding = Encoding.negotiate(request.get_header('Accept-Encoding', ''))
+    if encoding:
+        with Trace.current().stage('encode'):
+            body = Encoding.encode(body, encoding)
+        response.set_header('Content-Encoding', encoding)
+    return body
+
+
 def format_error_json(original_url: str, error_msg: str = None) -> dict:
     return {
         "success": False,
@@ -700,6 +1872,7 @@ def is_facebook_url(url: str) -> bool:
     return is_permalink or is_post or is_story or is_photo or is_group_post
 
 
+@timed('render')
 def format_reel_post_embed(post: ParsedPost) -> str:
     def get_video_meta_tag(link: str) -> str:
         return '\n'.join([
@@ -735,12 +1908,18 @@ def format_reel_post_embed(post: ParsedPost) -> str:
         </html>''')
 
 
-def format_full_post_embed(post: ParsedPost) -> str:
+@timed('render')
+def format_full_post_embed(post: ParsedPost, collage_url: str = '') -> str:
     if post.video_links:
         return format_reel_post_embed(post)
     image_links = post.image_links
-    image_counter = f'\ncontains 4+ images' if len(image_links) > 4 else ''
-    image_links = image_links[:4]
+    if collage_url:
+        # one image with all of them instead of the first four
+        image_counter = f'\n{len(image_links)} images'
+        image_links = [collage_url]
+    else:
+        image_counter = f'\ncontains 4+ images' if len(image_links) > 4 else ''
+        image_links = image_links[:4]
     image_meta_tags = '\n'.join([f'<meta property="og:image" content="{iu}"/>' for iu in image_links])
     post_date = Utils.timestamp_to_str(post.date)
     reaction_str = Utils.format_reactions_str(post.likes, post.comments, post.shares)
@@ -764,118 +1943,661 @@ def format_full_post_embed(post: ParsedPost) -> str:
         </html>''')
 
 
-def process_post(post_path: str) -> str:
-    post_path = post_path.removeprefix(WWWFB).removeprefix('/')
-    parsed_post = JsonParser.process_post(post_path)
-    if type(parsed_post) == ParsedPost:
-        return format_full_post_embed(parsed_post)
-    return format_error_message_embed(f'{WWWFB}/{post_path}')
+class Flight:
+    def __init__(self, leader: Trace):
+        self.leader = leader
+        self.done = threading.Event()
+        self.post: ParsedPost | None = None
+        self.error: Exception | None = None
+
+
+class PostCache:
+    FAILURE_TTL = 10
+
+    def __init__(self):
+        self.backend: CacheBackend = MemoryBackend()
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.flights: dict[str, Flight] = {}
+        self.lock = threading.Lock()
+
+    def set_backend(self, backend: CacheBackend):
+        old, self.backend = self.backend, backend
+        old.close()
+
+    def lookup(self, key: str) -> ParsedPost | FacebedException | None:
+        try:
+            data = self.backend.get(f'post:{key}')
+        except CacheError as e:
+            logging.warning(f'post cache lookup failed: {e}')
+            return None
+        if not data:
+            return None
+        if data.startswith(b'!'):  # recent failure, don't hammer facebook for it
+            return FacebedException(data[1:].decode('utf-8'))
+        return ParsedPost.loads(data)
+
+    def store(self, key: str, value: bytes, ttl: float):
+        try:
+            self.backend.set(key, value, ttl)
+        except CacheError as e:
+            logging.warning(f'post cache store failed: {e}')
+
+    def acquire(self, key: str) -> bool:
+        try:
+            return self.backend.acquire(f'lock:{key}', self.owner, config['fetch_lease'])
+        except CacheError as e:
+            logging.warning(f'post cache lock failed, fetching anyway: {e}')
+            return True
+
+    def release(self, key: str):
+        try:
+            self.backend.release(f'lock:{key}', self.owner)
+        except CacheError as e:
+            logging.warning(f'post cache unlock failed, lease will expire: {e}')
+
+    def is_warm(self, key: str) -> bool:
+        # fresh, recently failed or being fetched somewhere
+        if key in self.flights or self.lookup(key):
+            return True
+        try:
+            return self.backend.held(f'lock:{key}')
+        except CacheError:
+            return False
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], ParsedPost]) -> ParsedPost:
+        trace = Trace.current()
+        cached = self.lookup(key)
+        if cached:
+            trace.cache = 'hit'
+            if isinstance(cached, FacebedException):
+                raise cached
+            return cached
+
+        # threads of this process wait on a single flight
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight(trace)
+
+        if not leader:
+            trace.cache = 'coalesced'
+            scheduler.boost(flight.leader, trace.request_class)
+            if not flight.done.wait(config['fetch_lease']):
+                raise FacebedException('timed out waiting for upstream fetch')
+            if isinstance(flight.error, FacebedOverloaded):
+                # the leader's client or class was turned away, not necessarily ours
+                return self.get_or_fetch(key, fetch)
+            if flight.error:
+                raise flight.error
+            return flight.post
+
+        try:
+            flight.post = self.fetch_shared(key, fetch)
+            return flight.post
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def fetch_shared(self, key: str, fetch: Callable[[], ParsedPost]) -> ParsedPost:
+        # other nodes hold a lease while fetching, wait for their result instead of fetching again
+        trace = Trace.current()
+        acquired = self.acquire(key)
+        deadline = time.monotonic() + config['fetch_lease']
+        delay = 0.05
+        while not acquired and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+            cached = self.lookup(key)
+            if cached:
+                trace.cache = 'shared'
+                if isinstance(cached, FacebedException):
+                    raise cached
+                return cached
+            acquired = self.acquire(key)
+
+        # past the deadline the holder is presumed dead, its lease expires on its own
+        trace.cache = 'miss'
+        try:
+            post = fetch()
+            self.store(f'post:{key}', post.dumps(), config['post_cache_ttl'])
+            return post
+        except FacebedOverloaded:
+            raise
+        except Exception as e:
+            self.store(f'post:{key}', b'!' + str(e).encode('utf-8'), PostCache.FAILURE_TTL)
+            raise
+        finally:
+            if acquired:
+                self.release(key)
+
+    def resolve_share_link(self, path: str) -> str:
+        try:
+            resolved = self.backend.get(f'share:{path}')
+        except CacheError as e:
+            logging.warning(f'share link lookup failed: {e}')
+            resolved = None
+        if resolved is not None:
+            return resolved.decode('utf-8')
+
+        path_resolved = Utils.resolve_share_link(path)
+        if path_resolved:
+            self.store(f'share:{path}', path_resolved.encode('utf-8'), config['share_link_ttl'])
+        return path_resolved
+
+
+post_cache = PostCache()
+
+
+@on_config_change('cache_backend')
+def rebuild_cache_backend(new_config: dict):
+    post_cache.set_backend(create_cache_backend(new_config['cache_backend']))
+
+
+@dataclass
+class Route:
+    kind: str  # reel, photo, watch, post or invalid
+    path: str
+
+    @property
+    def key(self) -> str:
+        return f'{self.kind}:{self.path}'
+
+
+def resolve_route(path: str) -> Route | None:
+    # None if the share link could not be resolved
+    if re.match('^(/)?share/v/.*', path):
+        path = post_cache.resolve_share_link(path)
+        if not path:
+            return None
+
+    if re.match('^(/)?share/([pr]/)?[a-zA-Z0-9-._]*(/)?', path):
+        path = post_cache.resolve_share_link(path)
+        if not path:
+            return None
+
+    search = re.search(r'/videos/(\d+).*', path)
+    if search:
+        video_id = search.group(1)
+        path = f'reel/{video_id}'
+
+    if re.match(f'^/?reel/[0-9]+', path):
+        return Route('reel', path)
+
+    if re.match('^/*photo/*$', urlparse(path).path):
+        return Route('photo', path)
+
+    if re.match('^/*watch', urlparse(path).path):
+        return Route('watch', path)
+
+    if is_facebook_url(path):
+        return Route('post', path.removeprefix(WWWFB).removeprefix('/'))
+
+    return Route('invalid', path)
+
+
+PARSERS: dict[str, Callable[[str], ParsedPost]] = {
+    'reel': ReelsParser.process_post,
+    'photo': SinglePhotoParser.process_post,
+    'watch': VideoWatchParser.process_post,
+    'post': JsonParser.process_post,
+}
 
+STREAM_REQUIRED: dict[str, Callable[[str], list[tuple[str, ...]]]] = {
+    'reel': ReelsParser.required_blocks,
+    'photo': SinglePhotoParser.required_blocks,
+    'watch': VideoWatchParser.required_blocks,
+    'post': JsonParser.required_blocks,
+}
 
-def process_single_photo(post_path: str) -> str:
-    parsed_post = SinglePhotoParser.process_post(post_path)
-    if type(parsed_post) == ParsedPost:
-        return format_full_post_embed(parsed_post)
-    return format_error_message_embed(f'{WWWFB}/{post_path}')
+PAGE_PARSERS: dict[str, Callable[[PageBlocks, str], ParsedPost]] = {
+    'reel': ReelsParser.parse_page,
+    'photo': SinglePhotoParser.parse_page,
+    'watch': VideoWatchParser.parse_page,
+    'post': JsonParser.parse_page,
+}
+
+
+def fetch_post(route: Route) -> ParsedPost:
+    trace = Trace.current()
+    trace.route = route.kind
+    trace.key = route.key
+    post = post_cache.get_or_fetch(route.key, lambda: scheduler.run(trace, lambda: PARSERS[route.kind](route.path)))
+    # checked after the cache so ban list changes apply to cached posts right away
+    if is_banned(post.author_id):
+        return banned(post.url)
+    return post
+
+
+trusted_networks: list[ipaddress.IPv4Network | ipaddress.IPv6Network] = []
+
+
+@on_config_change('trusted_proxies')
+def rebuild_trusted_networks(new_config: dict):
+    global trusted_networks
+    trusted_networks = [ipaddress.ip_network(str(p), strict=False) for p in new_config['trusted_proxies']]
+
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address.strip())
+    except ValueError:
+        return False
+    ip = getattr(ip, 'ipv4_mapped', None) or ip
+    return any(ip in network for network in trusted_networks)
+
+
+def client_address() -> str:
+    # X-Forwarded-For is whatever the client wants it to be, only believe the hops our own proxies added
+    address = request.environ.get('REMOTE_ADDR', '')
+    if not is_trusted_proxy(address):
+        return address
+    for hop in reversed(request.environ.get('HTTP_X_FORWARDED_FOR', '').split(',')):
+        hop = hop.strip()
+        if hop and not is_trusted_proxy(hop):
+            return hop
+    return address
+
+
+def classify_request(request_class: str):
+    trace = Trace.current()
+    trace.request_class = request_class
+    trace.client = f'key:{get_api_key()}' if is_authorized() else client_address()
 
 
 @app.route('/api/<path:path>')
 def api_index(path: str):
     response.content_type = 'application/json'
-    
-    if request.query_string:
-        path += f'?{request.query_string}'
+    classify_request('api')
+
+    # pretty is ours, don't forward it to facebook
+    query_string = '&'.join([q for q in request.query_string.split('&') if q and q.split('=')[0] != 'pretty'])
+    if query_string:
+        path += f'?{query_string}'
 
     if 'type' in request.query.dict and '3' in request.query.dict['type']:
-        return json.dumps(format_error_json(f'{WWWFB}/{path}'))
+        return api_response(format_error_json(f'{WWWFB}/{path}'))
 
     try:
-        if re.match('^(/)?share/v/.*', path):
-            path = Utils.resolve_share_link(path)
-            if not path:
-                return json.dumps(format_error_json(f'{WWWFB}/{path}'))
-
-        if re.match('^(/)?share/([pr]/)?[a-zA-Z0-9-._]*(/)?', path):
-            path = Utils.resolve_share_link(path)
-            if not path:
-                return json.dumps(format_error_json(f'{WWWFB}/{path}'))
-
-        search = re.search(r'/videos/(\d+).*', path)
-        if search:
-            video_id = search.group(1)
-            path = f'reel/{video_id}'
-
-        if re.match(f'^/?reel/[0-9]+', path):
-            parsed_post = ReelsParser.process_post(path)
-            return json.dumps(format_parsed_post_json(parsed_post), ensure_ascii=False, indent=2)
-
-        if re.match('^/*photo/*$', urlparse(path).path):
-            parsed_post = SinglePhotoParser.process_post(path)
-            return json.dumps(format_parsed_post_json(parsed_post), ensure_ascii=False, indent=2)
-
-        if re.match('^/*watch', urlparse(path).path):
-            parsed_post = VideoWatchParser.process_post(path)
-            return json.dumps(format_parsed_post_json(parsed_post), ensure_ascii=False, indent=2)
-
-        if is_facebook_url(path):
-            path_clean = path.removeprefix(WWWFB).removeprefix('/')
-            parsed_post = JsonParser.process_post(path_clean)
-            return json.dumps(format_parsed_post_json(parsed_post), ensure_ascii=False, indent=2)
-        else:
-            return json.dumps(format_error_json('https://git.facebed.com', 'Invalid Facebook URL format'))
-
+        route = resolve_route(path)
+        if route is None:
+            return api_response(format_error_json(f'{WWWFB}/{path}'))
+        if route.kind == 'invalid':
+            return api_response(format_error_json('https://git.facebed.com', 'Invalid Facebook URL format'))
+
+        path = route.path
+        parsed_post = fetch_post(route)
+        return api_response(format_parsed_post_json(parsed_post))
+
+    except FacebedRateLimited as e:
+        response.status = 429
+        response.set_header('Retry-After', '1')
+        return api_response(format_error_json(f'{WWWFB}/{path}', str(e)))
     except FacebedException as e:
-        print(traceback.format_exc())
-        return json.dumps(format_error_json(f'{WWWFB}/{path}', str(e)))
+        Trace.current().fail(e)
+        return api_response(format_error_json(f'{WWWFB}/{path}', str(e)))
     except Exception as e:
-        print(traceback.format_exc())
-        return json.dumps(format_error_json(f'{WWWFB}/{path}', f'Unexpected error: {str(e)}'))
+        Trace.current().fail(e)
+        return api_response(format_error_json(f'{WWWFB}/{path}', f'Unexpected error: {str(e)}'))
 
 
-@app.route('/<path:path>')
-def index(path: str):
-    if request.query_string:
-        path += f'?{request.query_string}'
+class Prefetcher:
+    def __init__(self):
+        self.queue: queue.Queue[tuple[str, str]] = queue.Queue()
+        self.queued: set[str] = set()
+        self.workers: list[threading.Thread] = []
+        self.lock = threading.Lock()
 
-    if 'type' in request.query.dict and '3' in request.query.dict['type']:
-        return format_error_message_embed(f'{WWWFB}/{path}')
+    @staticmethod
+    def normalize_url(url: str) -> str | None:
+        # accepts facebook urls, facebed urls and bare paths, returns the path index() would see
+        url = url.strip()
+        if not url:
+            return None
+        parsed = urlparse(url if '://' in url else f'{WWWFB}/{url.removeprefix("/")}')
+        host = (parsed.hostname or '').lower()
+        if not (host == 'facebook.com' or host.endswith('.facebook.com') or host == request.urlparts.hostname):
+            return None
+        path = parsed.path.removeprefix('/')
+        if not path:
+            return None
+        return f'{path}?{parsed.query}' if parsed.query else path
+
+    def ensure_workers(self):
+        with self.lock:
+            self.workers = [w for w in self.workers if w.is_alive()]
+            while len(self.workers) < config['prefetch_workers']:
+                worker = threading.Thread(target=self.work, daemon=True)
+                worker.start()
+                self.workers.append(worker)
+
+    def submit(self, path: str, client: str) -> str:
+        # share links need a network round trip to route, those are checked by the worker
+        if not re.match('^(/)?share/', path):
+            route = resolve_route(path)
+            if route.kind == 'invalid':
+                return 'invalid'
+            if post_cache.is_warm(route.key):
+                return 'skipped'
+
+        with self.lock:
+            if path in self.queued:
+                return 'skipped'
+            if len(self.queued) >= config['prefetch_queue_size']:
+                return 'dropped'
+            self.queued.add(path)
+        self.queue.put((path, client))
+        return 'queued'
+
+    def work(self):
+        while True:
+            path, client = self.queue.get()
+            trace = Trace()
+            trace.client = client
+            trace.request_class = 'prefetch'
+            current_trace.set(trace)
+            try:
+                route = resolve_route(path)
+                if route and route.kind != 'invalid' and not post_cache.is_warm(route.key):
+                    post_cache.get_or_fetch(route.key, lambda: scheduler.run(trace, lambda: PARSERS[route.kind](route.path)))
+            except Exception as e:
+                logging.info(f'prefetch of {path} failed: {e}')
+            finally:
+                with self.lock:
+                    self.queued.discard(path)
+
+
+prefetcher = Prefetcher()
+
+
+def get_api_key() -> str:
+    auth = request.get_header('Authorization', '')
+    return auth.removeprefix('Bearer ').strip() if auth.startswith('Bearer ') else ''
 
+
+def is_authorized() -> bool:
+    key = get_api_key()
+    return bool(key) and any([hmac.compare_digest(key.encode(), str(k).encode()) for k in config['api_keys']])
+
+
+@app.route('/prefetch', method='POST')
+def prefetch():
+    response.content_type = 'application/json'
+    if not is_authorized():
+        response.status = 401
+        response.set_header('WWW-Authenticate', 'Bearer')
+        return dump_json({'success': False, 'error': 'Unauthorized'})
+
+    body = request.body.read().decode('utf-8', 'replace')
     try:
-        if re.match('^(/)?share/v/.*', path):
-            path = Utils.resolve_share_link(path)
-            if not path:
-                return format_error_message_embed(f'{WWWFB}/{path}')
+        payload = json.loads(body)
+    except ValueError:
+        payload = body.splitlines()
+    urls = payload.get('urls') if isinstance(payload, dict) else payload
+    if not isinstance(urls, list) or not all([isinstance(u, str) for u in urls]):
+        response.status = 400
+        return dump_json({'success': False, 'error': 'Expected {"urls": [...]} or one url per line'})
+
+    prefetcher.ensure_workers()
+    results: dict[str, str] = {}
+    for url in urls:
+        path = Prefetcher.normalize_url(url)
+        results[url] = prefetcher.submit(path, f'key:{get_api_key()}') if path else 'invalid'
+
+    response.status = 202
+    return dump_json({'success': True, 'results': results})
+
+
+@app.route('/stats')
+def stats():
+    response.content_type = 'application/json'
+    if not is_authorized():
+        response.status = 401
+        response.set_header('WWW-Authenticate', 'Bearer')
+        return dump_json({'success': False, 'error': 'Unauthorized'})
 
-        if re.match('^(/)?share/([pr]/)?[a-zA-Z0-9-._]*(/)?', path):
-            path = Utils.resolve_share_link(path)
-            if not path:
-                return format_error_message_embed(f'{WWWFB}/{path}')
+    return dump_json({
+        'success': True,
+        'extraction': extraction_paths.stats(),
+        'parse_admission': parse_admission.stats(),
+        'scheduler': scheduler.stats(),
+    }, pretty=True)
 
-        search = re.search(r'/videos/(\d+).*', path)
-        if search:
-            video_id = search.group(1)
-            path = f'reel/{video_id}'
 
-        if re.match(f'^/?reel/[0-9]+', path):
-            return format_reel_post_embed(ReelsParser.process_post(path))
+unfurler_pattern: re.Pattern | None = None
 
-        if re.match('^/*photo/*$', urlparse(path).path):
-            return process_single_photo(path)
 
-        if re.match('^/*watch', urlparse(path).path):
-            return format_reel_post_embed(VideoWatchParser.process_post(path))
+@on_config_change('unfurler_agents')
+def rebuild_unfurler_pattern(new_config: dict):
+    global unfurler_pattern
+    # whole product tokens only, so Line/ doesn't match Pipeline/1.0
+    agents = [rf'(?<![a-z0-9]){re.escape(str(agent))}' + (r'(?![a-z0-9])' if str(agent)[-1].isalnum() else '')
+              for agent in new_config['unfurler_agents'] if agent]
+    unfurler_pattern = re.compile('|'.join(agents), re.IGNORECASE) if agents else None
+
+
+def is_unfurler(user_agent: str) -> bool:
+    # no user agent at all is more likely a bot than a browser
+    if not user_agent:
+        return True
+    return bool(unfurler_pattern and unfurler_pattern.search(user_agent))
 
-        if is_facebook_url(path):
-            return process_post(path)
-        else:
-            return format_error_message_embed('https://git.facebed.com')
 
+def render_collage(image_links: list[str], filename: str):
+    # runs in a collage worker process
+    from PIL import Image, ImageOps
 
-    except FacebedException:
-        print(traceback.format_exc())
+    def download(url: str):
+        try:
+            image_response = rq.get(url, timeout=10)
+            image_response.raise_for_status()
+            return Image.open(io.BytesIO(image_response.content)).convert('RGB')
+        except Exception as e:
+            logging.info(f'collage image {url} failed: {e}')
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        images = [image for image in pool.map(download, image_links) if image]
+    if not images:
+        raise FacebedException('none of the collage images could be downloaded')
+
+    cell, gap = Collage.CELL, Collage.GAP
+    cols = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / cols)
+    canvas = Image.new('RGB', (cols * cell + (cols - 1) * gap, rows * cell + (rows - 1) * gap), Collage.BACKGROUND)
+    for i, image in enumerate(images):
+        row, col = divmod(i, cols)
+        # center the last row if it isn't full
+        offset = (cols - (len(images) - row * cols)) * (cell + gap) // 2 if row == rows - 1 else 0
+        tile = ImageOps.fit(image, (cell, cell), Image.Resampling.LANCZOS)
+        canvas.paste(tile, (offset + col * (cell + gap), row * (cell + gap)))
+
+    tmp = f'{filename}.{os.getpid()}.tmp'
+    canvas.save(tmp, 'JPEG', quality=85, optimize=True)
+    os.replace(tmp, filename)
+
+
+class Collage:
+    CELL = 512
+    GAP = 4
+    BACKGROUND = (24, 25, 28)
+    MAX_AGE = 365 * 24 * 3600
+    # used when collage_secret isn't set, collage urls then only work on this process until it restarts
+    FALLBACK_SECRET = os.urandom(32).hex()
+
+    def __init__(self):
+        self.pool: concurrent.futures.ProcessPoolExecutor | None = None
+        self.pending: dict[str, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    @cache
+    def pillow_installed() -> bool:
+        return importlib.util.find_spec('PIL') is not None
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(config['collage_dir']) and Collage.pillow_installed()
+
+    @staticmethod
+    def image_set(post: ParsedPost) -> list[str]:
+        return post.image_links[:config['collage_max_images']]
+
+    @staticmethod
+    def digest(image_links: list[str]) -> str:
+        # the fbcdn query string is a signature that changes between fetches, the path is the image
+        return hashlib.sha1('\n'.join(urlparse(link).path for link in image_links).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def signature(key: str, digest: str) -> str:
+        secret = (config['collage_secret'] or Collage.FALLBACK_SECRET).encode('utf-8')
+        return hmac.new(secret, f'{key}\n{digest}'.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+    @staticmethod
+    def token_for(key: str, image_links: list[str]) -> str:
+        encoded = base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii').rstrip('=')
+        digest = Collage.digest(image_links)
+        return f'{encoded}.{digest}.{Collage.signature(key, digest)}.jpg'
+
+    @staticmethod
+    def parse_token(token: str) -> tuple[str, str] | None:
+        # only tokens this server handed out, the key decides what gets fetched with the cookies
+        parts = token.split('.')
+        if len(parts) != 4 or parts[3] != 'jpg' or not re.fullmatch('[0-9a-f]{16}', parts[1]):
+            return None
+        try:
+            key = base64.urlsafe_b64decode(parts[0] + '=' * (-len(parts[0]) % 4)).decode('utf-8')
+        except ValueError:
+            return None
+        if not hmac.compare_digest(parts[2], Collage.signature(key, parts[1])):
+            return None
+        return key, parts[1]
+
+    @staticmethod
+    def file_for(key: str, digest: str) -> str:
+        return os.path.join(config['collage_dir'], f'{hashlib.sha1(key.encode("utf-8")).hexdigest()}-{digest}.jpg')
+
+    @staticmethod
+    def url_for(key: str, post: ParsedPost) -> str:
+        # '' when the embed should list the images as before
+        if not Collage.enabled() or post.video_links or len(post.image_links) < 2:
+            return ''
+        base = config['public_url'].rstrip('/') or f'{request.urlparts.scheme}://{request.urlparts.netloc}'
+        return f'{base}/collage/{Collage.token_for(key, Collage.image_set(post))}'
+
+    def render(self, key: str, image_links: list[str]) -> str:
+        filename = Collage.file_for(key, Collage.digest(image_links))
+        if os.path.isfile(filename):
+            return filename
+
+        with self.lock:
+            future = self.pending.get(filename)
+            if future is None or (future.done() and future.exception()):
+                if self.pool is None:
+                    import multiprocessing
+                    # the server is threaded, don't fork it
+                    self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=config['collage_workers'],
+                                                                       mp_context=multiprocessing.get_context('spawn'))
+                os.makedirs(config['collage_dir'], exist_ok=True)
+                future = self.pool.submit(render_collage, image_links, filename)
+                self.pending[filename] = future
+
+        try:
+            future.result(timeout=config['collage_timeout'])
+        except concurrent.futures.process.BrokenProcessPool:
+            self.reset()
+            raise
+        with self.lock:
+            if self.pending.get(filename) is future:
+                del self.pending[filename]
+
+        prune_oldest([os.path.join(config['collage_dir'], name) for name in os.listdir(config['collage_dir'])
+                      if name.endswith('.jpg')], config['collage_max_mb'] * 1024 * 1024)
+        return filename
+
+    def reset(self):
+        with self.lock:
+            pool, self.pool = self.pool, None
+            self.pending.clear()
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+collage_renderer = Collage()
+
+
+@on_config_change('collage_workers')
+def reset_collage_pool(new_config: dict):
+    collage_renderer.reset()
+
+
+@app.route('/collage/<token>')
+def collage(token: str):
+    parsed = Collage.parse_token(token)
+    if not parsed or not Collage.enabled():
+        return HTTPResponse(status=404)
+    key, digest = parsed
+    # signed keys come from resolved routes, resolving them again must land on the same one
+    route = resolve_route(key.partition(':')[2])
+    if route is None or route.kind not in PARSERS or route.key != key:
+        return HTTPResponse(status=404)
+
+    filename = Collage.file_for(key, digest)
+    if not os.path.isfile(filename):
+        classify_request('unfurler')
+        try:
+            image_links = Collage.image_set(fetch_post(route))
+            if len(image_links) < 2:
+                return HTTPResponse(status=404)
+            filename = collage_renderer.render(key, image_links)
+        except Exception as e:
+            Trace.current().fail(e)
+            return HTTPResponse(status=502)
+
+    # the url names the image set, so it never changes unless the post's images did
+    if filename.endswith(f'-{digest}.jpg'):
+        cache_control = f'public, max-age={Collage.MAX_AGE}, immutable'
+    else:
+        cache_control = 'public, max-age=300'
+    return static_file(os.path.basename(filename), root=config['collage_dir'], mimetype='image/jpeg',
+                       headers={'Cache-Control': cache_control})
+
+
+@app.route('/<path:path>')
+def index(path: str):
+    if request.query_string:
+        path += f'?{request.query_string}'
+
+    if 'type' in request.query.dict and '3' in request.query.dict['type']:
         return format_error_message_embed(f'{WWWFB}/{path}')
-    except Exception:
-        print(traceback.format_exc())
+
+    # browsers only follow the refresh back to facebook, send them there without fetching anything
+    if config['redirect_browsers']:
+        response.set_header('Vary', 'User-Agent')
+    if config['redirect_browsers'] and not is_unfurler(request.get_header('User-Agent', '')):
+        Trace.current().route = 'browser'
+        redirect(f'{WWWFB}/{path}', 302)
+    classify_request('unfurler')
+
+    try:
+        route = resolve_route(path)
+        if route is None:
+            return format_error_message_embed(f'{WWWFB}/{path}')
+        if route.kind == 'invalid':
+            return format_error_message_embed('https://git.facebed.com')
+
+        path = route.path
+        parsed_post = fetch_post(route)
+        if route.kind in ['reel', 'watch']:
+            return format_reel_post_embed(parsed_post)
+        return format_full_post_embed(parsed_post, collage_renderer.url_for(route.key, parsed_post))
+
+    except Exception as e:
+        Trace.current().fail(e)
         return format_error_message_embed(f'{WWWFB}/{path}')
 
 
@@ -897,54 +2619,332 @@ def root():
         return f.read().replace('{|CREDIT|}', get_credit())
 
 
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname}
+        entry.update(getattr(record, 'fields', None) or {'msg': record.getMessage()})
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class DeferredQueueHandler(QueueHandler):
+    # leave formatting to the listener thread, only resolve what can't cross threads
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging():
+    root = logging.getLogger()
+    access_handler = logging.StreamHandler(sys.stdout)
+    access_handler.setFormatter(JsonLineFormatter())
+    access_handler.addFilter(logging.Filter(access_logger.name))
+    for handler in root.handlers:
+        handler.addFilter(lambda record: not record.name.startswith(access_logger.name))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *root.handlers, access_handler)
+    root.handlers = [DeferredQueueHandler(log_queue)]
+    listener.start()
+    atexit.register(listener.stop)
+
+
 def log_to_logger(fn):
     @wraps(fn)
     def _log_to_logger(*argsz, **kwargs):
-        actual_response = fn(*argsz, **kwargs)
-        logging.info('%s %s %s %s' % (request.remote_addr, request.method, request.url, response.status))
-        return actual_response
+        trace = Trace()
+        token = current_trace.set(trace)
+        start = time.perf_counter()
+        status = 500
+        try:
+            actual_response = fn(*argsz, **kwargs)
+            # static_file and the error paths return their own response instead of setting the global one
+            status = actual_response.status_code if isinstance(actual_response, HTTPResponse) else response.status_code
+            return actual_response
+        except HTTPResponse as e:
+            status = e.status_code
+            raise
+        except Exception as e:
+            trace.fail(e)
+            raise
+        finally:
+            current_trace.reset(token)
+            trace.emit(status, time.perf_counter() - start)
 
     return _log_to_logger
 
 
-def main():
-    global config
+class ConfigError(Exception):
+    pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def load_config(path: str) -> dict:
+    if not os.path.isfile(path):
+        raise ConfigError(f'config file {path} not found or is not a file')
+    if not os.access(path, os.R_OK):
+        raise ConfigError(f'config file {path} not readable')
+
+    with open(path, 'r', encoding='utf-8') as f:
+        try:
+            loaded = yaml.safe_load(f) or {}
+        except yaml.YAMLError as e:
+            raise ConfigError(f'config file {path} is not valid yaml: {e}')
+
+    if not isinstance(loaded, dict):
+        raise ConfigError(f'config file {path} is not a mapping')
+
+    new_config = dict(default_config)
+    new_config.update(loaded)
+    for k in new_config:
+        if k in default_config and type(default_config[k]) == float and type(new_config[k]) == int:
+            new_config[k] = float(new_config[k])
+        if k not in default_config or type(new_config[k]) != type(default_config[k]):
+            raise ConfigError(f'invalid config entry {k}')
+
+    if new_config['timezone'] < -12 or new_config['timezone'] > 14:
+        raise ConfigError('invalid timezone offset')
+
+    if new_config['cache_backend'] not in ['', 'memory']:
+        if not new_config['cache_backend'].startswith('redis://'):
+            raise ConfigError(f'unknown cache backend {new_config['cache_backend']}')
+        parsed = urlparse(new_config['cache_backend'])
+        try:
+            # the same parsing RedisBackend does, both raise ValueError on a bad port or db
+            parsed.port
+            int(parsed.path.strip('/') or 0)
+        except ValueError:
+            raise ConfigError(f'invalid cache backend {new_config['cache_backend']}, expected redis://[user:password@]host:port/db')
+
+    for proxy in new_config['trusted_proxies']:
+        try:
+            ipaddress.ip_network(str(proxy), strict=False)
+        except ValueError:
+            raise ConfigError(f'invalid trusted proxy {proxy}')
+
+    # per class, so setting one class doesn't drop the defaults of the others
+    new_config['scheduler_weights'] = {**default_config['scheduler_weights'], **new_config['scheduler_weights']}
+    for request_class, weight in new_config['scheduler_weights'].items():
+        if type(weight) not in [int, float] or weight <= 0:
+            raise ConfigError(f'invalid scheduler weight for {request_class}')
+
+    rate_limits = {}
+    for request_class in default_config['rate_limits'].keys() | new_config['rate_limits'].keys():
+        limit = new_config['rate_limits'].get(request_class, {})
+        if not isinstance(limit, dict):
+            raise ConfigError(f'invalid rate limit for {request_class}')
+        limit = {**default_config['rate_limits'].get(request_class, {}), **limit}
+        if any(type(limit.get(k)) not in [int, float] or limit[k] < 0 for k in ['rate', 'burst']):
+            raise ConfigError(f'invalid rate limit for {request_class}, rate and burst must be numbers >= 0')
+        rate_limits[request_class] = limit
+    new_config['rate_limits'] = rate_limits
+
+    return new_config
+
+
+def reload_config(path: str) -> bool:
+    try:
+        new_config = load_config(path)
+    except ConfigError as e:
+        logging.error(f'config reload failed, keeping the current config: {e}')
+        return False
+
+    # the listening socket is already bound
+    for key in ['host', 'port']:
+        if new_config[key] != config[key]:
+            logging.warning(f'changing {key} requires a restart, keeping {config[key]}')
+            new_config[key] = config[key]
 
+    try:
+        changed = apply_config(new_config)
+    except ConfigError as e:
+        logging.error(f'config reload failed, keeping the current config: {e}')
+        return False
+    logging.info(f'config reloaded from {path}, changed: {", ".join(sorted(changed)) or "nothing"}')
+    return True
+
+
+class ConfigWatcher:
+    def __init__(self, path: str):
+        self.path = path
+        self.last_stat = self.stat()
+
+    def stat(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.path)
+            return st.st_mtime_ns, st.st_size
+        except OSError:
+            return None
+
+    def start(self):
+        if hasattr(signal, 'SIGHUP'):
+            # don't reload inside the signal handler, it interrupts the server loop
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=self.reload, daemon=True).start())
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def reload(self):
+        self.last_stat = self.stat()
+        try:
+            reload_config(self.path)
+        except Exception:
+            # keep watching, the next change may fix it
+            logging.exception(f'config reload from {self.path} failed')
+
+    def watch(self):
+        while True:
+            interval = config['config_watch_interval']
+            time.sleep(interval if interval > 0 else 5)
+            if interval > 0 and self.stat() != self.last_stat:
+                self.reload()
+
+
+def reparse_archived(filename: str) -> tuple[str, bytes | None, str]:
+    # runs in a worker process, returns the key, the serialized post and the error if any
+    try:
+        record = PageArchive.load(filename)
+    except (OSError, ValueError) as e:
+        return filename, None, f'unreadable archive: {e}'
+    key = record['key']
+    try:
+        page = PageBlocks([(content_len, text) for content_len, text in record['blocks']])
+        return key, PAGE_PARSERS[record['kind']](page, record['path']).dumps(), ''
+    except Exception as e:
+        return key, None, f'{type(e).__name__}: {e}'
+
+
+def reparse_archive(populate: bool) -> int:
+    files = PageArchive.files(config['archive_dir'])
+    if not files:
+        logging.error(f'no archived pages in {config['archive_dir'] or "(archive_dir is not set)"}')
+        return 1
+    if populate and not config['cache_backend'].startswith('redis://'):
+        logging.warning('--populate only makes sense with a shared cache_backend, the memory cache is gone on exit')
+
+    ok = 0
+    with concurrent.futures.ProcessPoolExecutor(initializer=apply_config, initargs=(config,)) as pool:
+        for key, data, error in pool.map(reparse_archived, files, chunksize=8):
+            if data is None:
+                print(f'FAIL {key}: {error}')
+                continue
+            ok += 1
+            print(f'OK   {key}')
+            if populate:
+                post_cache.store(f'post:{key}', data, config['post_cache_ttl'])
+    print(f'{ok}/{len(files)} archived pages parsed')
+    return 0 if ok == len(files) else 2
+
+
+def check_stream_archived(filename: str) -> tuple[str, str, str]:
+    # runs in a worker process, parses the full page and the part stream mode would have read
+    try:
+        record = PageArchive.load(filename)
+    except (OSError, ValueError) as e:
+        return filename, 'skip', f'unreadable archive: {e}'
+    key, kind, path = record['key'], record['kind'], record['path']
+    if record.get('streamed'):
+        return key, 'skip', 'archived from a streamed fetch'
+
+    page = PageBlocks([(content_len, text) for content_len, text in record['blocks']])
+    try:
+        full = PAGE_PARSERS[kind](page, path).dumps()
+    except Exception as e:
+        return key, 'skip', f'full page does not parse: {type(e).__name__}: {e}'
+    streamed = PageBlocks(JsonParser.stream_prefix(page.blocks, STREAM_REQUIRED[kind](path)))
+    try:
+        partial = PAGE_PARSERS[kind](streamed, path).dumps()
+    except Exception as e:
+        return key, 'diff', f'stream mode fails: {type(e).__name__}: {e}'
+    if partial != full:
+        return key, 'diff', 'stream mode parses a different post'
+    return key, 'same', ''
+
+
+def check_stream_archive() -> int:
+    files = PageArchive.files(config['archive_dir'])
+    if not files:
+        logging.error(f'no archived pages in {config['archive_dir'] or "(archive_dir is not set)"}')
+        return 1
+
+    results = {'same': 0, 'diff': 0, 'skip': 0}
+    with concurrent.futures.ProcessPoolExecutor(initializer=apply_config, initargs=(config,)) as pool:
+        for key, result, detail in pool.map(check_stream_archived, files, chunksize=8):
+            results[result] += 1
+            if result == 'diff':
+                print(f'DIFF {key}: {detail}')
+    print(f'{results['same']}/{results['same'] + results['diff']} archived pages parse the same in stream mode, '
+          f'{results['skip']} skipped')
+    return 0 if not results['diff'] else 2
+
+
+def warm_up():
+    # pays for the lazy imports and the cookies before the first request has to
+    for module in LAZY_MODULES:
+        module.load()
+    acc.get_cookies()
+
+
+def print_startup_profile():
+    total = sum(seconds for _, seconds in startup_timings)
+    for name, seconds in startup_timings:
+        print(f'{seconds * 1000:9.1f} ms  {name}')
+    print(f'{total * 1000:9.1f} ms  total')
+
+
+def main():
     parser = argparse.ArgumentParser(description='Facebook embed server')
     parser.add_argument('-c', '--config', type=str, help='config yaml file path')
+    parser.add_argument('--reparse', action='store_true', help='run the parsers over the page archive and exit')
+    parser.add_argument('--populate', action='store_true', help='with --reparse, store the parsed posts in the cache')
+    parser.add_argument('--check-stream', action='store_true',
+                        help='check that stream_upstream parses the archived pages the same and exit')
+    parser.add_argument('--startup-profile', action='store_true', help='print import and init timings and exit')
     args = parser.parse_args()
+    startup_timings.insert(0, ('import facebed', time.perf_counter() - IMPORT_STARTED))
 
     if args.config:
-        if not os.path.isfile(args.config):
-            logging.error(f'config file {args.config} not found or is not a file')
-            exit(1)
-        if not os.access(args.config, os.R_OK):
-            logging.error(f'config file {args.config} not readable')
+        try:
+            with startup_stage('load config'):
+                new_config = load_config(args.config)
+        except ConfigError as e:
+            logging.error(str(e))
             exit(1)
-
-        with open(args.config, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
-        for dk in default_config:
-            if dk not in config:
-                config[dk] = default_config[dk]
-        for k in config:
-            if k not in default_config or type(config[k]) != type(default_config[k]):
-                logging.error(f'invalid config entry {k}')
-                exit(1)
     else:
-        config = default_config
-
-    if config['timezone'] < -12 or config['timezone'] > 14:
-        logging.critical('invalid timezone offset')
-        exit(1)
+        new_config = dict(default_config)
 
     if sys.version_info.minor < 12:
         logging.error('python 3.12+ required, see https://docs.python.org/3.12/whatsnew/3.12.html#pep-701-syntactic-formalization-of-f-strings')
         exit(1)
 
+    try:
+        with startup_stage('apply config'):
+            apply_config(new_config)
+    except ConfigError as e:
+        logging.error(str(e))
+        exit(1)
+    if args.reparse:
+        exit(reparse_archive(args.populate))
+    if args.check_stream:
+        exit(check_stream_archive())
+    if args.startup_profile:
+        warm_up()
+        print_startup_profile()
+        exit(0)
+
+    setup_logging()
+    if args.config:
+        ConfigWatcher(args.config).start()
+    # the socket is bound right away, the first requests wait on the imports if they beat this
+    threading.Thread(target=warm_up, daemon=True).start()
+
     logging.info(f'listening on {config['host']}:{config['port']}')
     app.install(log_to_logger)
-    app.run(host=config['host'], port=config['port'], quiet=True)
+    app.run(host=config['host'], port=config['port'], quiet=True, server_class=ThreadingWSGIServer)
 
 
 if __name__ == '__main__':